@@ -1,7 +1,9 @@
+import hashlib
+import hmac
+import random
+import threading
+import time
 import streamlit as st
-import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
 from datetime import datetime, timezone, timedelta
 
 # ------------------------
@@ -15,26 +17,52 @@ SPREADSHEET_NAME = "customer_counter"
 # スプレッドシートのヘッダーを「累計」専用に変更
 EXPECTED_HEADERS = ['時刻', '累計']
 JST = timezone(timedelta(hours=+9))
+# スプレッドシートに書き込む時刻の形式（読み込み時もこの形式で解析する）
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# 未保存の記録がこの件数に達したら、まとめてスプレッドシートに書き込む
+FLUSH_THRESHOLD = 20
+# 最初の未保存の記録からこの秒数が経ったら、件数に関係なく書き込む
+FLUSH_INTERVAL_SECONDS = 3
+# 一時的なエラーとして再試行するHTTPステータス（レート制限とサーバーエラー）
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+# 他のプロセスや手作業で追加された行がないか、グラフ用の履歴の末尾を確認する間隔（秒）
+TAIL_REFRESH_SECONDS = 60
 
 # ------------------------
 # 🔒 パスワード認証
 # ------------------------
+@st.cache_resource
+def load_password_digest():
+    """secrets.toml からパスワードのSHA-256ダイジェスト（bytes）を求める。プロセス内で一度だけ実行される"""
+    auth_secrets = st.secrets["auth"]
+    # パスワードのSHA-256（16進文字列）が設定されていればそれを使い、なければ平文のパスワードから求める
+    if "password_sha256" in auth_secrets:
+        return bytes.fromhex(auth_secrets["password_sha256"])
+    return hashlib.sha256(auth_secrets["password"].encode()).digest()
+
 def authenticate_user():
     """ユーザー認証を行う"""
     try:
-        PASSWORD = st.secrets["auth"]["password"]
+        PASSWORD_DIGEST = load_password_digest()
     except KeyError:
         st.error("認証用のパスワードが secrets.toml に設定されていません。")
         st.stop()
+    except ValueError:
+        st.error("secrets.toml の password_sha256 が16進文字列になっていません。")
+        st.stop()
 
     if "authenticated" not in st.session_state:
         st.session_state.authenticated = False
 
     if not st.session_state.authenticated:
         st.title("🔒 累計カウンター（ログイン）")
-        password_input = st.text_input("パスワード", type="password", key="password_input")
-        if st.button("ログイン", key="login_button"):
-            if password_input == PASSWORD:
+        # フォームにまとめ、ログインボタンが押されたときだけ再実行されるようにする
+        with st.form("login_form"):
+            password_input = st.text_input("パスワード", type="password", key="password_input")
+            submitted = st.form_submit_button("ログイン")
+        if submitted:
+            input_digest = hashlib.sha256(password_input.encode()).digest()
+            if hmac.compare_digest(input_digest, PASSWORD_DIGEST):
                 st.session_state.authenticated = True
                 st.rerun()
             else:
@@ -43,28 +71,34 @@ def authenticate_user():
 
 authenticate_user()
 
+# 重いライブラリはログイン後にだけ読み込み、ログイン画面の再実行を軽くする
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import gspread
+from google.oauth2.service_account import Credentials
+
 # ------------------------
 # ✅ Googleスプレッドシート接続 & 初期化
 # ------------------------
+def _authorize():
+    """サービスアカウントの認証情報でgspreadクライアントを作成する"""
+    credentials = Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"], scopes=GSPREAD_SCOPES
+    )
+    return gspread.authorize(credentials)
+
 @st.cache_resource
-def setup_gspread_connection():
-    """Google Sheetsへの接続を確立し、ワークシートオブジェクトを返す"""
-    try:
-        credentials = Credentials.from_service_account_info(
-            st.secrets["gcp_service_account"], scopes=GSPREAD_SCOPES
-        )
-        gc = gspread.authorize(credentials)
-        sh = gc.open(SPREADSHEET_NAME)
-        worksheet = sh.sheet1
-        initialize_worksheet(worksheet)
-        return worksheet
-    except gspread.exceptions.SpreadsheetNotFound:
-        st.error(f"スプレッドシート '{SPREADSHEET_NAME}' が見つかりません。")
-        st.info("同名のスプレッドシートを作成し、サービスアカウントに共有してください。")
-        return None
-    except Exception as e:
-        st.error(f"Google認証または接続に失敗: {e}")
-        return None
+def get_worksheet():
+    """
+    Google Sheetsへの接続からワークシートの取得・初期化までを行い、ワークシートオブジェクトを返す。
+    失敗した場合は例外をそのまま送出する（例外はキャッシュされないため、次回の再実行で再接続される）。
+    """
+    gc = _authorize()
+    worksheet = gc.open(SPREADSHEET_NAME).sheet1
+    initialize_worksheet(worksheet)
+    return worksheet
 
 def initialize_worksheet(worksheet):
     """ワークシートのヘッダーを確認し、必要であれば作成する"""
@@ -84,48 +118,295 @@ def initialize_worksheet(worksheet):
 # ------------------------
 # 📊 データ取得と状態管理
 # ------------------------
+def _batch_read(worksheet, ranges):
+    """複数の範囲を1回のリクエストでまとめて取得し、範囲ごとに1列分の値のリストを返す"""
+    response = worksheet.spreadsheet.values_batch_get(
+        [gspread.utils.absolute_range_name(worksheet.title, r) for r in ranges],
+        params={'majorDimension': 'COLUMNS'},
+    )
+    return [value_range.get('values', [[]])[0] for value_range in response['valueRanges']]
+
+def _read_rows(worksheet, range_name, **kwargs):
+    """
+    worksheet.get で範囲を読み、行のリストを返す。
+    空の範囲では gspread 6 が [[]] を返すため、値のある行が1つもなければ [] に揃える
+    （[[]] を1行と数えると、読み込み済みの行番号が実際のシートより先に進んでしまう）。
+    """
+    values = worksheet.get(range_name, **kwargs)
+    return list(values) if any(values) else []
+
+def _parse_history(timestamps, totals):
+    """時刻と累計の値のリストから、時刻をインデックスにしたDataFrameを作る"""
+    # 時刻の文字列はPythonオブジェクトの列にせず、Arrowの文字列配列のままC++側で一括して解析する
+    parsed = pc.strptime(pa.array(timestamps, type=pa.string()), format=TIMESTAMP_FORMAT, unit="s", error_is_null=True)
+    times = pd.Series(parsed.to_pandas()).astype("datetime64[ns]")
+    # 以前 USER_ENTERED で書き込んだ行はシートの表示形式（例: 2026/10/15 9:05:05）で返るため、
+    # 固定の形式で読めなかった行だけを柔軟な解析で読み直す
+    raw_times = pd.Series(timestamps, dtype=object)
+    unparsed = times.isna() & raw_times.notna()
+    if unparsed.any():
+        times[unparsed] = pd.to_datetime(raw_times[unparsed], format="mixed", errors="coerce")
+    df = pd.DataFrame({"時刻": times, "累計": pd.Series(totals, dtype=object)})
+    df["累計"] = pd.to_numeric(df["累計"], errors="coerce")
+    # それでも読めない時刻・数値でない累計の行はグラフの対象から外し、件数を知らせる
+    row_count = len(df)
+    df = df.dropna(subset=["時刻", "累計"])
+    if len(df) < row_count:
+        st.warning(f"形式が正しくない {row_count - len(df)} 行をグラフから除外しました。")
+    df["累計"] = pd.to_numeric(df["累計"].astype("int64"), downcast="unsigned")
+    # Pythonのdateオブジェクトではなく、0時に切り捨てたdatetime64で日付を持つ
+    df["日付"] = df["時刻"].dt.normalize()
+    # 時刻順のインデックスにしておき、日付での絞り込みを二分探索のスライスで行えるようにする
+    return df.set_index("時刻").sort_index(kind="stable")
+
+@st.cache_resource
+def _shared_state():
+    """
+    全セッションで共有する最新の累計と履歴。
+    書き込みに成功した側がその場で更新するので、読み込み側はスプレッドシートを読み直さなくてよい。
+    """
+    return {"lock": threading.Lock(), "total": None, "history": None, "last_row": None,
+            "date_options": [], "tail_checked_at": 0.0}
+
+def _parse_rows(rows):
+    """[時刻, 累計] の行のリストを _parse_history で解析する"""
+    return _parse_history(
+        [row[0] if row else None for row in rows],
+        [row[1] if len(row) > 1 else None for row in rows],
+    )
+
+def _append_history(state, new_df, row_count):
+    """
+    解析済みの行を共有の履歴の末尾に追加し、読み込み済みの行を row_count 行進める。
+    呼び出し側で lock を取得しておくこと（解析やスプレッドシートの読み込みはロックの外で済ませておく）。
+    """
+    state["last_row"] += row_count
+    if new_df.empty:
+        return
+    history = state["history"]
+    if not history.empty and new_df.index[0] < history.index[-1]:
+        # 他のセッションが先に書き込んだ場合など、書き込み順が時刻順でないときは並べ直して日付も作り直す
+        # （時刻のインデックスが単調でないと、日付でのスライスや時間帯ごとの集計ができない）
+        state["history"] = pd.concat([history, new_df]).sort_index(kind="stable")
+        state["date_options"] = list(state["history"]["日付"].unique()[::-1])
+        return
+    state["history"] = pd.concat([history, new_df])
+    # 追加した行は既存の行より新しいので、まだない日付だけを新しい順にして先頭に加える
+    newest = state["date_options"][0] if state["date_options"] else None
+    new_dates = [d for d in new_df["日付"].unique()[::-1] if newest is None or d > newest]
+    if new_dates:
+        state["date_options"] = new_dates + state["date_options"]
+
+def fetch_dataframe(worksheet, force_refresh=False):
+    """
+    スプレッドシートの全履歴のDataFrameと、グラフで選択できる日付（新しい順）を返す。
+    全件を読み込むのはプロセスの初回だけで、以降はこのアプリからの書き込み時に履歴へ追加していく。
+    過去の行は変わらないので読み直さず、前回読み込んだ行より後ろの行だけを
+    TAIL_REFRESH_SECONDS ごと（force_refresh が指定されたときはすぐに）取得して追加する。
+    """
+    state = _shared_state()
+    with state["lock"]:
+        loaded = state["history"] is not None
+        last_row = state["last_row"]
+        tail_due = loaded and (
+            force_refresh or time.monotonic() - state["tail_checked_at"] >= TAIL_REFRESH_SECONDS
+        )
+        if tail_due:
+            # 他のセッションが同時に同じ末尾を読みに行かないよう、確認した時刻を先に記録しておく
+            state["tail_checked_at"] = time.monotonic()
+
+    # スプレッドシートの読み込みと解析はロックの外で行い、他のセッションのカウンター操作を待たせない
+    if not loaded:
+        # 時刻と累計の列を1回のリクエストで列ごとに取得する（ヘッダーは initialize_worksheet で確認済み）
+        timestamps, totals = _batch_read(worksheet, ['A2:A', 'B2:B'])
+        try:
+            history = _parse_history(timestamps, totals)
+        except (TypeError, ValueError):
+            st.error("スプレッドシートのデータ形式が正しくありません。")
+            return pd.DataFrame(columns=EXPECTED_HEADERS), []
+        with state["lock"]:
+            # 読み込み中に他のセッションが先に読み込みを終えていれば、そちらを使う
+            if state["history"] is None:
+                state["history"] = history
+                state["last_row"] = 1 + len(timestamps)
+                # 時刻順に並んでいるので、日付の出現順がそのまま古い順になる（ソート不要）
+                state["date_options"] = list(history["日付"].unique()[::-1])
+                state["tail_checked_at"] = time.monotonic()
+    elif tail_due:
+        new_rows = _read_rows(worksheet, f"A{last_row + 1}:B")
+        if new_rows:
+            try:
+                new_df = _parse_rows(new_rows)
+            except (TypeError, ValueError):
+                # 読み込み済みの履歴はそのまま表示し、解析できなかった行は読み飛ばして次回以降は読み直さない
+                st.error("スプレッドシートに形式が正しくない行があるため、一部の記録をグラフに反映できません。")
+                new_df = _parse_history([], [])
+            # 末尾の読み込みはシートの最終行まで読むので、最後の累計は他のプロセスや手作業の書き込みも含めた最新の累計になる
+            tail_total = _last_valid_total([row[1:] for row in new_rows], default=None)
+            with state["lock"]:
+                if state["last_row"] == last_row:
+                    _append_history(state, new_df, len(new_rows))
+                    if tail_total is not None:
+                        state["total"] = tail_total
+                else:
+                    # 読み込み中に書き込みで履歴が進んだ場合は、重複を避けて捨て、次の再実行で読み直す
+                    state["tail_checked_at"] = 0.0
+    with state["lock"]:
+        return state["history"], state["date_options"]
+
+def hourly_totals(daily_data):
+    """1日分のデータから、各時間帯（0〜23時）の終わり時点の累計を返す"""
+    hours = daily_data.index.hour.to_numpy()
+    totals = daily_data["累計"].to_numpy()
+    # 時間帯ごとに最後の行の位置を1回の走査で求め、記録のない時間帯は直前の時間帯の値を引き継ぐ
+    last_idx = np.full(24, -1)
+    np.maximum.at(last_idx, hours, np.arange(len(hours)))
+    last_idx = np.maximum.accumulate(last_idx)
+    counts = np.where(last_idx >= 0, totals[last_idx.clip(0)], 0)
+    return pd.Series(counts, index=pd.RangeIndex(24, name="時間帯"), name="累計")
+
 @st.cache_data(ttl=60)
-def fetch_dataframe(_worksheet):
-    """スプレッドシートから全データを取得し、DataFrameとして返す"""
-    records = _worksheet.get_all_records()
-    if not records:
-        return pd.DataFrame(columns=EXPECTED_HEADERS)
-    df = pd.DataFrame(records)
-    try:
-        df["累計"] = pd.to_numeric(df["累計"])
-        df["時刻"] = pd.to_datetime(df["時刻"])
-        df["日付"] = df["時刻"].dt.date
-    except (KeyError, TypeError):
-        st.error("スプレッドシートのデータ形式が正しくありません。")
-        return pd.DataFrame(columns=EXPECTED_HEADERS)
-    return df
+def compute_hourly_totals(data_version, selected_date, _df):
+    """
+    選択した日付の時間帯ごとの累計を返す（その日のデータがなければ None）。
+    DataFrame自体のハッシュ計算を避けるため、data_version（行数と最終時刻）をキャッシュのキーにする。
+    """
+    day_start = pd.Timestamp(selected_date)
+    day_end = day_start + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+    daily_data = _df.loc[day_start:day_end]
+    if daily_data.empty:
+        return None
+    return hourly_totals(daily_data)
+
+def fetch_last_total(worksheet):
+    """最新の累計を返す。プロセスの初回だけ累計の列を取得し、以降は共有の値を使う（全履歴は取得しない）"""
+    state = _shared_state()
+    with state["lock"]:
+        total = state["total"]
+    if total is not None:
+        return total
+    # スプレッドシートの読み込みはロックの外で行う（ヘッダーだけの新しいシートでは空になる）
+    values = _read_rows(worksheet, "B2:B", value_render_option='UNFORMATTED_VALUE')
+    with state["lock"]:
+        # 読み込み中に書き込みで累計が更新されていれば、そちらを優先する
+        if state["total"] is None:
+            state["total"] = _last_valid_total(values)
+        return state["total"]
+
+def _last_valid_total(values, default=0):
+    """累計の列の値から、数値として読める最後の累計を返す（_parse_history と同様に、読めないセルは飛ばす。なければ default）"""
+    for row in reversed(values):
+        if not row:
+            continue
+        try:
+            return int(float(row[0]))
+        except (TypeError, ValueError, OverflowError):
+            continue
+    return default
 
 def initialize_app_state(worksheet):
     """アプリの初回起動時に累計を読み込む"""
     if "initialized" in st.session_state:
         return
-    df = fetch_dataframe(worksheet)
-    st.session_state.df = df
-    st.session_state.total_visitors = df["累計"].iloc[-1] if not df.empty else 0
+    st.session_state.total_visitors = fetch_last_total(worksheet)
+    st.session_state.setdefault("pending_rows", [])
     st.session_state.initialized = True
 
 # ★★★★★ ここがデータをスプレッドシートに保存する関数です ★★★★★
 def record_visit(worksheet, new_total):
     """
-    ボタンが押された時の時刻と新しい累計人数をスプレッドシートに記録（保存）する関数。
+    ボタンが押された時の時刻と新しい累計人数を未保存の記録に追加する関数。
+    未保存の記録が一定数たまったら、まとめてスプレッドシートに保存する。
     """
+    timestamp = datetime.now(JST).strftime(TIMESTAMP_FORMAT)
+    if not st.session_state.pending_rows:
+        st.session_state.pending_since = time.monotonic()
+    st.session_state.pending_rows.append([timestamp, new_total])
+    if len(st.session_state.pending_rows) >= FLUSH_THRESHOLD or is_flush_due():
+        flush_pending(worksheet)
+
+def is_flush_due():
+    """未保存の記録があり、最初の記録から FLUSH_INTERVAL_SECONDS 秒以上経っているかを返す"""
+    if not st.session_state.pending_rows:
+        return False
+    return time.monotonic() - st.session_state.pending_since >= FLUSH_INTERVAL_SECONDS
+
+def _with_backoff(fn, *args, retries=5, base_delay=0.25, **kwargs):
+    """一時的なAPIエラーのときは、待ち時間を倍々に延ばしながら（ゆらぎ付き）fn を再試行する"""
+    for attempt in range(retries):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status_code = getattr(e.response, "status_code", None)
+            if status_code not in RETRYABLE_STATUS_CODES or attempt == retries - 1:
+                raise
+            time.sleep(base_delay * (2 ** attempt) + random.random() * 0.1)
+
+def _updated_end_row(response):
+    """values.append のレスポンスから、書き込まれた範囲の最後の行番号を返す（分からなければ None）"""
+    updated_range = (response or {}).get("updates", {}).get("updatedRange")
+    if not updated_range:
+        return None
+    # 例: 'シート1'!A102:B103 → B103 → 103
+    last_cell = updated_range.rsplit("!", 1)[-1].split(":")[-1]
     try:
-        timestamp = datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
-        # ↓ この行が、実際にスプレッドシートに新しい行を追加してデータを保存しています。
-        worksheet.append_row([timestamp, new_total], value_input_option='USER_ENTERED')
-        # キャッシュをクリアして、グラフ表示などが次回更新時に最新になるようにする
-        st.cache_data.clear()
+        return gspread.utils.a1_to_rowcol(last_cell)[0]
+    except gspread.exceptions.IncorrectCellLabel:
+        return None
+
+def flush_pending(worksheet):
+    """未保存の記録を1回の通信でまとめてスプレッドシートに保存する"""
+    pending_rows = st.session_state.pending_rows
+    if not pending_rows:
+        return
+    try:
+        # ↓ この行が、実際にスプレッドシートに新しい行をまとめて追加してデータを保存しています。
+        # 時刻の文字列と整数の累計だけなので、RAWでそのまま書き込みサーバー側の解析を省く
+        # append_rows の代わりに values.append を直接呼び、書き込んだ値をレスポンスに含めないよう指定する
+        response = _with_backoff(
+            worksheet.spreadsheet.values_append,
+            gspread.utils.absolute_range_name(worksheet.title, 'A1'),
+            params={
+                'valueInputOption': 'RAW',
+                'insertDataOption': 'INSERT_ROWS',
+                'includeValuesInResponse': False,
+            },
+            body={'values': pending_rows},
+        )
+        st.session_state.pending_rows = []
+        # 書き込んだ行で共有の累計と履歴を更新し、読み直しを不要にする
+        # 解析はロックの外で、履歴が読み込み済みのときだけ行う（ロック内で読み込み済みかを改めて確認する）
+        end_row = _updated_end_row(response)
+        state = _shared_state()
+        new_df = _parse_rows(pending_rows) if state["history"] is not None else None
+        with state["lock"]:
+            state["total"] = pending_rows[-1][1]
+            if state["history"] is not None:
+                if new_df is not None and end_row is not None and end_row - len(pending_rows) == state["last_row"]:
+                    _append_history(state, new_df, len(pending_rows))
+                else:
+                    # 外部で追加された未読込の行の後ろに書き込まれた場合（または解析前に履歴が読み込まれた場合）は、
+                    # 行番号がずれないよう手元では追加せず、次の再実行での末尾の読み込みにまとめて任せる
+                    state["tail_checked_at"] = 0.0
     except Exception as e:
         st.error(f"スプレッドシートへの書き込み（保存）に失敗しました: {e}")
 
 # --- メイン処理 ---
-worksheet = setup_gspread_connection()
-if worksheet is None: st.stop()
+# ヘッダーの確認はプロセスごとに一度だけ行う。シートを外部で編集した場合は ?reinit=1 で確認し直す
+if st.query_params.get("reinit") == "1":
+    get_worksheet.clear()
+    _shared_state.clear()
+    del st.query_params["reinit"]
+
+try:
+    worksheet = get_worksheet()
+except gspread.exceptions.SpreadsheetNotFound:
+    st.error(f"スプレッドシート '{SPREADSHEET_NAME}' が見つかりません。")
+    st.info("同名のスプレッドシートを作成し、サービスアカウントに共有してください。")
+    st.stop()
+except Exception as e:
+    st.error(f"Google認証または接続に失敗: {e}")
+    st.stop()
 
 initialize_app_state(worksheet)
 
@@ -134,62 +415,71 @@ initialize_app_state(worksheet)
 # ------------------------
 st.title("👥 累計カウンター")
 
-# 「累計来客数」の表示のみに変更
-st.metric(label="累計来客数", value=f"{st.session_state.total_visitors} 人")
+# ボタン操作ではこの部分だけを再実行し、データ読み込みやグラフ描画はやり直さない
+# 5秒ごとにも再実行し、たまった記録の書き込みと他の端末で記録された累計の反映を行う
+@st.fragment(run_every="5s")
+def counter_ui(worksheet):
+    """累計の表示と、記録・リセット・保存のボタン"""
+    # 連続して押されなくなった後も、未保存の記録が残り続けないよう定期実行のたびに確認する
+    if is_flush_due():
+        flush_pending(worksheet)
+    # 未保存の記録がなければスプレッドシートの累計に合わせる（あれば手元の累計を優先する）
+    if not st.session_state.pending_rows:
+        st.session_state.total_visitors = fetch_last_total(worksheet)
 
-st.divider()
+    # 「累計来客数」の表示のみに変更
+    st.metric(label="累計来客数", value=f"{st.session_state.total_visitors} 人")
 
-# 「+1」ボタンのみに変更
-if st.button("＋1", use_container_width=True, type="primary", help="来客を1人追加して記録します。"):
-    new_total = st.session_state.total_visitors + 1
-    st.session_state.total_visitors = new_total
-    # ボタンが押されたら、記録（保存）関数を呼び出す
-    record_visit(worksheet, new_total)
-    st.rerun()
-
-with st.expander("⚠️ 管理者用リセット"):
-    if st.button("累計を0に戻す"):
-        st.session_state.total_visitors = 0
-        # 0になったことも記録（保存）する
-        record_visit(worksheet, 0)
-        st.rerun()
+    st.divider()
+
+    # 「+1」ボタンのみに変更
+    if st.button("＋1", use_container_width=True, type="primary", help="来客を1人追加して記録します。"):
+        new_total = st.session_state.total_visitors + 1
+        st.session_state.total_visitors = new_total
+        # ボタンが押されたら、記録（保存）関数を呼び出す
+        record_visit(worksheet, new_total)
+        st.rerun(scope="fragment")
+
+    with st.expander("⚠️ 管理者用リセット"):
+        if st.button("累計を0に戻す"):
+            st.session_state.total_visitors = 0
+            # 0になったことも記録（保存）する
+            record_visit(worksheet, 0)
+            st.rerun(scope="fragment")
+
+    # 未保存の記録があれば件数を表示し、「保存」ボタンでまとめて書き込む
+    pending_count = len(st.session_state.pending_rows)
+    if pending_count:
+        st.caption(f"未保存の記録: {pending_count} 件")
+    if st.button("保存", use_container_width=True, disabled=not pending_count, help="未保存の記録をスプレッドシートに保存します。"):
+        flush_pending(worksheet)
+        st.rerun(scope="fragment")
+
+counter_ui(worksheet)
 
 # ------------------------
 # 📈 グラフ表示
 # ------------------------
-df = st.session_state.df
-if not df.empty:
-    st.divider()
+# 全履歴の取得は重いため、グラフを表示するときだけ読み込む
+st.divider()
+show_chart = st.checkbox("グラフを表示")
+# ボタン操作ではグラフは再描画されないため、最新の記録を反映したいときは「グラフ更新」を押す
+refresh_chart = show_chart and st.button("グラフ更新")
+df, date_options = fetch_dataframe(worksheet, force_refresh=refresh_chart) if show_chart else (None, [])
+if df is not None and not df.empty:
     st.subheader("📈 累計の推移")
     
-    # 日付を選択して、その日の累計の推移を表示
-    date_options = sorted(df["日付"].unique(), reverse=True)
-    selected_date = st.selectbox("グラフを表示する日付を選択", options=date_options)
+    # 日付を選択して、その日の時間帯ごとの累計の推移を表示
+    data_version = (len(df), df.index[-1])
+    selected_date = st.selectbox(
+        "グラフを表示する日付を選択",
+        options=date_options,
+        format_func=lambda d: pd.Timestamp(d).strftime("%Y-%m-%d"),
+    )
     
-    if selected_date:
-        daily_data = df[df["日付"] == selected_date].copy()
-        if not daily_data.empty:
-            # グラフが見やすいように、時刻をインデックスに設定
-            daily_data.set_index('時刻', inplace=True)
-            st.bar_chart(daily_data['累計'])
+    if selected_date is not None:
+        hourly_data = compute_hourly_totals(data_version, pd.Timestamp(selected_date), df)
+        if hourly_data is not None:
+            st.bar_chart(hourly_data)
         else:
             st.info("その日のデータはありません。")
-
-
-解説：データが保存される仕組み
-ご質問いただいた「スプレッドシートへの保存」は、新しいコードの**record_visit**という関数が担当しています。
-# ★★★★★ ここがデータをスプレッドシートに保存する関数です ★★★★★
-def record_visit(worksheet, new_total):
-    """
-    ボタンが押された時の時刻と新しい累計人数をスプレッドシートに記録（保存）する関数。
-    """
-    try:
-        timestamp = datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
-        # ↓ この行が、実際にスプレッドシートに新しい行を追加してデータを保存しています。
-        worksheet.append_row([timestamp, new_total], value_input_option='USER_ENTERED')
-        
-        st.cache_data.clear()
-    except Exception as e:
-        st.error(f"スプレッドシートへの書き込み（保存）に失敗しました: {e}")
-
-